@@ -0,0 +1,311 @@
+import atexit
+import json
+from multiprocessing import resource_tracker, shared_memory
+
+from loguru import logger
+
+import numpy as np
+import pandas as pd
+
+from utils_recommendation import DEFECT_PARTITION_COLUMNS, get_defect_length
+
+# column layout of a published snapshot, every column is stored as one contiguous array
+SNAPSHOT_COLUMNS = [
+    ("defect_id", np.int64),
+    ("defect_code_id", np.int64),
+    ("start_pos", np.float64),
+    ("end_pos", np.float64),
+    ("length", np.float64),
+    # partition columns are optional, stored as codes into the snapshot's partition keys, -1 if missing
+    ("line_id", np.int64),
+    ("subsys_id", np.int64),
+    ("measurement_type_id", np.int64),
+    ("sorted_index", np.int64),  # defect row order by start_pos
+]
+
+# control block holds the current version, data blocks hold n_rows and the size of the
+# partition key lookup table, followed by the columns and the lookup table as json
+_CONTROL_SIZE = np.dtype(np.int64).itemsize
+_HEADER_SIZE = 2 * np.dtype(np.int64).itemsize
+_ATTACH_RETRIES = 5
+
+# blocks created by publishers of this process, still tracked for cleanup
+_owned_blocks = set()
+
+# attached blocks whose arrays were still referenced when their snapshot was closed
+_deferred_close = []
+
+
+def _data_block_name(name: str, version: int):
+    return f"{name}_v{version}"
+
+
+def _get_column_values(defect: pd.DataFrame, column: str, dtype):
+    """Returns column of defect as dtype, raises ValueError if it cannot be stored losslessly"""
+    if column not in defect.columns:
+        raise ValueError(f"defect table has no {column} column")
+
+    if pd.api.types.is_integer_dtype(defect[column]):
+        return defect[column].values.astype(dtype)
+    try:
+        values = defect[column].to_numpy(dtype=np.float64, na_value=np.nan)
+    except (TypeError, ValueError):
+        raise ValueError(f"{column} must be numeric")
+
+    if np.isnan(values).any():
+        raise ValueError(f"{column} must not contain missing values")
+    if dtype == np.int64 and (values != np.round(values)).any():
+        raise ValueError(f"{column} must contain integer values")
+    return values.astype(dtype)
+
+
+def _get_partition_codes(defect: pd.DataFrame, column: str):
+    """Returns codes of partition column and its keys, keys may be numbers or strings"""
+    if column not in defect.columns:
+        return np.full(len(defect), -1, dtype=np.int64), []
+
+    codes, keys = pd.factorize(defect[column])
+    keys = keys.tolist()
+    if not all(isinstance(key, (int, float, str)) for key in keys):
+        raise ValueError(f"{column} must contain numbers or strings")
+    return codes.astype(np.int64), keys
+
+
+def _close_deferred():
+    """Closes deferred blocks whose arrays have been released meanwhile"""
+    for shm in _deferred_close[:]:
+        try:
+            shm.close()
+        except BufferError:
+            continue  # arrays still referenced
+        _deferred_close.remove(shm)
+
+
+@atexit.register
+def _release_deferred():
+    """Drops remaining deferred blocks without unmapping, the mapping ends with the process"""
+    _close_deferred()
+    for shm in _deferred_close:
+        # SharedMemory.__del__ would otherwise fail on the still exported buffer
+        shm._buf = shm._mmap = None
+    _deferred_close.clear()
+
+
+def _attach(block_name: str):
+    """Attaches to an existing shared memory block without taking ownership of it
+
+    The resource tracker of the attaching process would otherwise unlink
+    the block when that process exits, removing it for every other reader.
+    """
+    shm = shared_memory.SharedMemory(name=block_name)
+    if block_name not in _owned_blocks:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class DefectSnapshot:
+    """Read-only view on a published defect snapshot
+
+    Args:
+        shm (shared_memory.SharedMemory): attached data block
+        version (int): version of the snapshot
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, version: int):
+        self._shm = shm
+        self.version = version
+        self.n_rows, keys_size = (int(value) for value in np.frombuffer(shm.buf, dtype=np.int64, count=2))
+
+        self.columns = {}
+        offset = _HEADER_SIZE
+        for column, dtype in SNAPSHOT_COLUMNS:
+            array = np.frombuffer(shm.buf, dtype=dtype, count=self.n_rows, offset=offset)
+            array.flags.writeable = False
+            self.columns[column] = array
+            offset += array.nbytes
+        self.partition_keys = json.loads(bytes(shm.buf[offset : offset + keys_size]))
+
+    def __getitem__(self, column: str):
+        return self.columns[column]
+
+    def __len__(self):
+        return self.n_rows
+
+    def to_frame(self):
+        """Returns the snapshot as defect dataframe over the shared arrays, e.g. to pass to get_anomaly_recommendation
+
+        Numeric columns are read-only views, not copies. Partition columns are
+        decoded to categoricals. Pass self["sorted_index"] as defect_sorted_index
+        to get_anomaly_recommendation to skip sorting the defects.
+
+        Returns:
+            defect (pd.DataFrame): defect_id, defect_code_id, positions, length and partition columns
+        """
+        columns = {
+            column: self.columns[column]
+            for column, _ in SNAPSHOT_COLUMNS
+            if column not in DEFECT_PARTITION_COLUMNS + ["sorted_index"]
+        }
+        for column in DEFECT_PARTITION_COLUMNS:
+            columns[column] = pd.Categorical.from_codes(
+                self.columns[column], categories=self.partition_keys[column]
+            )
+        return pd.DataFrame(columns, copy=False)
+
+    def close(self):
+        """Detaches from the data block
+
+        If arrays of this snapshot are still referenced elsewhere, the block
+        stays mapped and closing is retried on the next close or refresh,
+        so those arrays remain valid until they are released.
+        """
+        self.columns = {}
+        _deferred_close.append(self._shm)
+        _close_deferred()
+
+
+class DefectSnapshotPublisher:
+    """Publishes immutable defect snapshots into shared memory
+
+    Every publish writes a new versioned data block and only then bumps the
+    version in the control block, so readers always see a complete snapshot.
+    The previous data block is unlinked; readers attached to it keep their
+    mapping until they close it.
+
+    Args:
+        name (str): name of the shared memory control block
+    """
+
+    def __init__(self, name: str = "defect_snapshot"):
+        self.name = name
+        self.version = 0
+        self._control = shared_memory.SharedMemory(
+            name=name, create=True, size=_CONTROL_SIZE
+        )
+        self._control_version = np.ndarray((1,), dtype=np.int64, buffer=self._control.buf)
+        self._control_version[0] = 0
+        self._data = None
+        _owned_blocks.add(name)
+
+    def publish(self, defect: pd.DataFrame):
+        """Publishes defect table as new snapshot version
+
+        Args:
+            defect (pd.DataFrame): content of defect table
+
+        Returns:
+            version (int): version of the published snapshot
+
+        Raises:
+            ValueError: if ids, severities or positions are missing, non-numeric or not integral where required,
+                or partition keys are neither numbers nor strings
+        """
+        n_rows = len(defect)
+        values = {
+            column: _get_column_values(defect, column, dtype)
+            for column, dtype in SNAPSHOT_COLUMNS
+            if column not in DEFECT_PARTITION_COLUMNS + ["length", "sorted_index"]
+        }
+        values["length"] = get_defect_length(values["start_pos"], values["end_pos"])
+        values["sorted_index"] = np.argsort(values["start_pos"], kind="stable")
+        partition_keys = {}
+        for column in DEFECT_PARTITION_COLUMNS:
+            values[column], partition_keys[column] = _get_partition_codes(defect, column)
+        partition_keys = json.dumps(partition_keys).encode()
+
+        size = _HEADER_SIZE + len(partition_keys) + sum(
+            n_rows * np.dtype(dtype).itemsize for _, dtype in SNAPSHOT_COLUMNS
+        )
+        version = self.version + 1
+        data = shared_memory.SharedMemory(
+            name=_data_block_name(self.name, version), create=True, size=max(size, 1)
+        )
+        _owned_blocks.add(data.name)
+        np.ndarray((2,), dtype=np.int64, buffer=data.buf)[:] = (n_rows, len(partition_keys))
+        offset = _HEADER_SIZE
+        for column, dtype in SNAPSHOT_COLUMNS:
+            target = np.ndarray((n_rows,), dtype=dtype, buffer=data.buf, offset=offset)
+            target[:] = values[column]
+            offset += target.nbytes
+        data.buf[offset : offset + len(partition_keys)] = partition_keys
+
+        # swap in the new version only once the data block is complete
+        self._control_version[0] = version
+        old_data, self._data, self.version = self._data, data, version
+        if old_data is not None:
+            old_data.close()
+            old_data.unlink()
+            _owned_blocks.discard(old_data.name)
+
+        logger.debug(f"published defect snapshot {self.name} v{version} with {n_rows} defects")
+        return version
+
+    def close(self):
+        """Unlinks control and data blocks, attached readers keep their mapping"""
+        del self._control_version
+        for shm in (self._data, self._control):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+                _owned_blocks.discard(shm.name)
+        self._data = None
+
+
+def get_snapshot_version(name: str = "defect_snapshot"):
+    """Returns the currently published snapshot version
+
+    Args:
+        name (str): name of the shared memory control block
+
+    Returns:
+        version (int): current version, 0 if nothing has been published yet or the publisher has closed
+    """
+    try:
+        control = _attach(name)
+    except FileNotFoundError:
+        return 0
+    version = int(np.frombuffer(control.buf, dtype=np.int64, count=1)[0])
+    control.close()
+    return version
+
+
+def attach_defect_snapshot(name: str = "defect_snapshot"):
+    """Attaches zero-copy to the currently published defect snapshot
+
+    Args:
+        name (str): name of the shared memory control block
+
+    Returns:
+        snapshot (DefectSnapshot): read-only snapshot, None if nothing has been published yet or the publisher has closed
+    """
+    for _ in range(_ATTACH_RETRIES):
+        version = get_snapshot_version(name)
+        if version == 0:
+            return None
+        try:
+            return DefectSnapshot(_attach(_data_block_name(name, version)), version)
+        except FileNotFoundError:
+            # snapshot was swapped between reading the version and attaching
+            logger.debug(f"defect snapshot {name} v{version} replaced, retrying")
+
+    raise RuntimeError(f"could not attach to defect snapshot {name}")
+
+
+def refresh_defect_snapshot(snapshot: DefectSnapshot, name: str = "defect_snapshot"):
+    """Returns the latest snapshot, reusing the given one if it is still current
+
+    Args:
+        snapshot (DefectSnapshot): currently attached snapshot, may be None
+        name (str): name of the shared memory control block
+
+    Returns:
+        snapshot (DefectSnapshot): latest read-only snapshot
+    """
+    _close_deferred()
+    if snapshot is not None and snapshot.version == get_snapshot_version(name):
+        return snapshot
+
+    latest = attach_defect_snapshot(name)
+    if snapshot is not None:
+        snapshot.close()
+    return latest
@@ -1,7 +1,12 @@
 import pandas as pd
 import streamlit as st
 import numpy as np
-import io
+import os
+import tempfile
+import plotly.graph_objects as go
+
+from utils_export import write_inspection_csv, write_inspection_xlsx
+from utils_signal import get_minmax_decimation
 
 st.sidebar.title('Anomaly simulation')
 
@@ -54,10 +59,20 @@ for measurement_type in measurement_type_list:
             indices = np.where((distance >= anomaly_start_pos[i]) & (distance <= anomaly_end_pos[i]))
             measurement[indices,measurement_index] = anomaly_value[i]   
 
+# plot decimated channels, peaks are kept while at most 2*n_buckets points reach the browser
+fig = go.Figure()
+for measurement_type in measurement_type_list:
+    x_plot, y_plot = get_minmax_decimation(distance, measurement[:,measurement_types.index(measurement_type)], n_buckets=2000)
+    fig.add_trace(go.Scattergl(x=x_plot, y=y_plot, mode='lines', name=measurement_type))
+fig.update_layout(xaxis_title='distance', height=300)
+st.plotly_chart(fig, use_container_width=True)
+
 c1, c2, _ = st.columns(3)
 with c1:
     file_name = st.text_input(value='scenario',label='Please enter filename to be saved')
-    file_name = file_name+'.csv'
+with c2:
+    file_format = st.selectbox('File format',['csv','xlsx'])
+file_name = file_name+'.'+file_format
 
 if st.button('Get Data'):   
 
@@ -73,14 +88,22 @@ if st.button('Get Data'):
     alarms_to_save['High/Low'] = 'Low'
     alarms_to_save = alarms_to_save[['Channel','Meters','High/Low','value']]
 
-    output = io.BytesIO()
-    template.iloc[:14,0].to_csv(output,header=None,index=None)
-    pd.DataFrame(measurement,columns=measurement_types).to_csv(output,index=None, mode='a')
-    alarms_to_save.to_csv(output,index=None,mode='a')    
+    # write to a temporary file chunk by chunk, download_button then needs the file content as bytes
+    write_inspection = {'csv': write_inspection_csv, 'xlsx': write_inspection_xlsx}[file_format]
+    output_fd, output_path = tempfile.mkstemp(suffix='.'+file_format)
+    os.close(output_fd)
+    try:
+        with st.spinner(f'Exporting {file_name}'):
+            write_inspection(output_path, template.iloc[:14,0].to_list(),
+                             pd.DataFrame(measurement,columns=measurement_types), alarms_to_save)
+        with open(output_path, 'rb') as output:
+            data = output.read()
+    finally:
+        os.remove(output_path)
 
     st.download_button(
     label=f"Download {file_name}",
-    data=output,
+    data=data,
     file_name=file_name,
-    mime='text/csv',
-)
\ No newline at end of file
+    mime={'csv': 'text/csv', 'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}[file_format],
+)
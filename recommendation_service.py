@@ -0,0 +1,434 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+from loguru import logger
+
+import numpy as np
+import pandas as pd
+
+from utils_recommendation import (get_anomaly_recommendation, get_defect_length,
+                                  get_overlapping_defects)
+
+# anomalies are matched against defects of the same measurement type only
+SERVICE_PARTITION_COLUMNS = ["measurement_type_id"]
+
+ANOMALY_COLUMNS = ["anomaly_id", "defect_code_id", "start_pos", "end_pos"]
+
+
+class RecommendationError(Exception):
+    """Raised for a request whose recommendation failed inside a batch"""
+
+
+def _get_partition_key_values(values: pd.Series, numeric: bool):
+    """Returns partition key values as float64 if numeric else str, so that e.g. "1" and 1 match"""
+    if numeric:
+        return pd.to_numeric(values).astype(np.float64)
+    return values.astype(str)
+
+
+class DefectIndex:
+    """Warm defect tables per partition, built once per defect table load
+
+    Args:
+        defect (pd.DataFrame): content of defect table
+        partition_columns (list, optional): columns to partition defects by. Defaults to SERVICE_PARTITION_COLUMNS.
+    """
+
+    def __init__(self, defect: pd.DataFrame, partition_columns: list = None):
+        if partition_columns is None:
+            partition_columns = SERVICE_PARTITION_COLUMNS
+        self.partition_columns = [column for column in partition_columns if column in defect.columns]
+        defect = defect.assign(
+            length=get_defect_length(defect["start_pos"].values, defect["end_pos"].values)
+        )
+        self.n_defects = defect.shape[0]
+
+        # keys are compared as numbers where the defect table allows it, else as strings
+        self.numeric_partitions = {}
+        for column in self.partition_columns:
+            try:
+                defect[column] = _get_partition_key_values(defect[column], numeric=True)
+                self.numeric_partitions[column] = True
+            except (TypeError, ValueError):
+                defect[column] = _get_partition_key_values(defect[column], numeric=False)
+                self.numeric_partitions[column] = False
+
+        if self.partition_columns:
+            n_unpartitioned = defect[self.partition_columns].isna().any(axis=1).sum()
+            if n_unpartitioned:
+                logger.warning(f"{n_unpartitioned} defects without {self.partition_columns} are not indexed")
+            self.partitions = {
+                key: partition.reset_index(drop=True)
+                for key, partition in defect.groupby(self.partition_columns, sort=False)
+            }
+        else:
+            self.partitions = {None: defect.reset_index(drop=True)}
+        self.sorted_indices = {
+            key: np.argsort(partition["start_pos"].values.astype(float), kind="stable")
+            for key, partition in self.partitions.items()
+        }
+        self._empty = defect.iloc[:0]
+
+    def get_partition(self, key):
+        """Returns defects of partition key and their order by start_pos, empty if there are none"""
+        if key not in self.partitions:
+            return self._empty, np.zeros(0, dtype=int)
+        return self.partitions[key], self.sorted_indices[key]
+
+    def normalise_anomaly(self, anomaly: pd.DataFrame):
+        """Returns anomaly with partition keys in the dtype of the defect table (copy)
+
+        Args:
+            anomaly (pd.DataFrame): anomalies of one request
+
+        Returns:
+            anomaly (pd.DataFrame): anomalies ready to be grouped by partition_columns
+
+        Raises:
+            ValueError: if columns are missing or partition keys are missing or cannot be matched
+        """
+        missing_columns = [
+            column for column in ANOMALY_COLUMNS + self.partition_columns if column not in anomaly.columns
+        ]
+        if missing_columns:
+            raise ValueError(f"anomalies miss columns {missing_columns}")
+
+        anomaly = anomaly.copy()
+        for column in self.partition_columns:
+            if anomaly[column].isna().any():
+                raise ValueError(f"anomalies miss values of partition column {column}")
+            try:
+                anomaly[column] = _get_partition_key_values(anomaly[column], self.numeric_partitions[column])
+            except (TypeError, ValueError):
+                raise ValueError(f"{column} of anomalies cannot be matched to the defect table")
+        return anomaly
+
+    def iter_partitions(self, anomaly: pd.DataFrame):
+        """Yields (partition key, anomalies of that partition) of normalised anomalies"""
+        if not self.partition_columns:
+            yield None, anomaly.reset_index(drop=True)
+            return
+
+        for key, anomaly_partition in anomaly.groupby(self.partition_columns, sort=False):
+            yield key, anomaly_partition.reset_index(drop=True)
+
+
+class RecommendationService:
+    """Coalesces concurrent recommendation requests into micro-batches against a warm DefectIndex
+
+    Requests arriving within max_wait_ms of each other form one batch. The
+    overlap candidates of all anomalies of a batch are computed in one
+    vectorized pass per partition, while the severity/length decisions and
+    conflict resolution run per request, since conflict resolution in
+    get_anomaly_recommendation spans all anomalies of a call. Batches are
+    processed concurrently in the executor while the next batch is collected.
+
+    Args:
+        load_defect (callable): returns the content of the defect table
+        partition_columns (list, optional): columns to partition defects by. Defaults to SERVICE_PARTITION_COLUMNS.
+        max_batch_size (int): maximum number of requests per batch. Defaults to 64.
+        max_wait_ms (float): maximum time to wait for more requests. Defaults to 5.
+        recommendation_parameters (dict): parameters of get_anomaly_recommendation
+    """
+
+    def __init__(
+        self,
+        load_defect,
+        partition_columns: list = None,
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5,
+        recommendation_parameters: dict = None,
+    ):
+        self.load_defect = load_defect
+        self.partition_columns = partition_columns
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.recommendation_parameters = recommendation_parameters or {}
+
+        self.index = DefectIndex(load_defect(), partition_columns)
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.n_requests = 0
+        self._queue = None
+        self._batcher = None
+        self._batch_tasks = set()
+        self._reload_task = None
+
+    async def start(self):
+        """Starts the batching task, to be awaited inside the serving event loop"""
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+
+    async def recommend(self, anomaly: pd.DataFrame, anomaly_recommendation_id_start: int = 0):
+        """Returns anomaly_recommendation of anomaly, once its batch has been processed
+
+        Args:
+            anomaly (pd.DataFrame): anomalies of one request
+            anomaly_recommendation_id_start (int, optional): last index of anomaly recommendation table. Defaults to 0.
+
+        Returns:
+            anomaly_recommendation (pd.DataFrame): recommendation of all anomalies
+
+        Raises:
+            ValueError: if anomaly cannot be matched against the defect index
+            RecommendationError: if the recommendation failed inside the batch
+        """
+        # validate up front, so that one bad request cannot fail a whole batch
+        index = self.index
+        anomaly = index.normalise_anomaly(anomaly)
+        if "length" not in anomaly.columns:
+            anomaly["length"] = anomaly["end_pos"] - anomaly["start_pos"]
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((anomaly, anomaly_recommendation_id_start, future, time.perf_counter()))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # process without waiting, so the next batch is collected meanwhile
+            task = asyncio.ensure_future(self._dispatch_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _dispatch_batch(self, batch: list):
+        # a reload swaps self.index, the batch keeps the index it started with
+        results = await asyncio.get_running_loop().run_in_executor(
+            None, self._process_batch, self.index, batch
+        )
+        for (_, _, future, start), result in zip(batch, results):
+            if future.done():  # client went away
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(RecommendationError(str(result)))
+            else:
+                future.set_result(result)
+            self.latencies.append(time.perf_counter() - start)
+        self.batch_sizes.append(len(batch))
+        self.n_requests += len(batch)
+
+    def _process_batch(self, index: DefectIndex, batch: list):
+        parameters = self.recommendation_parameters
+
+        # collect the anomalies of all requests per partition
+        partitions = {}
+        for request_no, (anomaly, _, _, _) in enumerate(batch):
+            for key, anomaly_partition in index.iter_partitions(anomaly):
+                partitions.setdefault(key, []).append((request_no, anomaly_partition))
+
+        # overlap candidates of all requests of a partition in one vectorized pass
+        request_partitions = [[] for _ in batch]
+        results = [None] * len(batch)
+        for key, anomaly_partitions in partitions.items():
+            defect, sorted_index = index.get_partition(key)
+            try:
+                overlapping_defects = get_overlapping_defects(
+                    pd.concat([anomaly_partition for _, anomaly_partition in anomaly_partitions]),
+                    defect,
+                    sorted_index=sorted_index,
+                    proximity=parameters.get("proximity", 0),
+                    min_overlap_extent=parameters.get("min_overlap_extent", 0.1),
+                )
+            except Exception as e:
+                logger.exception(e)
+                for request_no, _ in anomaly_partitions:
+                    results[request_no] = e
+                continue
+
+            offset = 0
+            for request_no, anomaly_partition in anomaly_partitions:
+                n_anomalies = anomaly_partition.shape[0]
+                request_partitions[request_no].append(
+                    (anomaly_partition, defect, overlapping_defects[offset : offset + n_anomalies])
+                )
+                offset += n_anomalies
+
+        # decisions and conflict resolution per request
+        for request_no, (_, anomaly_recommendation_id_start, _, _) in enumerate(batch):
+            if results[request_no] is not None:
+                continue
+            try:
+                anomaly_rec_list = []
+                for anomaly_partition, defect, overlapping_defects in request_partitions[request_no]:
+                    anomaly_rec_list.append(
+                        get_anomaly_recommendation(
+                            anomaly_partition,
+                            defect,
+                            anomaly_recommendation_id_start=anomaly_recommendation_id_start,
+                            overlapping_defects=overlapping_defects,
+                            **parameters,
+                        )
+                    )
+                    anomaly_recommendation_id_start += anomaly_partition.shape[0]
+                results[request_no] = pd.concat(anomaly_rec_list, ignore_index=True).sort_values(
+                    by=["anomaly_id"]
+                )
+            except Exception as e:
+                logger.exception(e)
+                results[request_no] = e
+        return results
+
+    async def reload(self):
+        """Reloads the defect table in the background, requests are served from the old index meanwhile"""
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.ensure_future(self._reload())
+        return self._reload_task
+
+    async def _reload(self):
+        loop = asyncio.get_running_loop()
+        try:
+            index = await loop.run_in_executor(
+                None, lambda: DefectIndex(self.load_defect(), self.partition_columns)
+            )
+        except Exception as e:
+            logger.exception(e)  # keep serving from the current index
+            return
+        self.index = index
+        logger.info(f"reloaded defect index with {index.n_defects} defects")
+
+    def get_stats(self):
+        """Returns latency percentiles [ms] and batch size statistics of recent requests"""
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batch_sizes)
+        stats = {"n_requests": self.n_requests, "n_defects": self.index.n_defects}
+        if len(latencies):
+            stats.update(
+                {
+                    f"latency_p{p}_ms": float(np.percentile(latencies, p))
+                    for p in (50, 90, 99)
+                }
+            )
+            stats.update(
+                {
+                    "batch_size_mean": float(batch_sizes.mean()),
+                    "batch_size_max": int(batch_sizes.max()),
+                }
+            )
+        return stats
+
+
+async def _handle_request(service: RecommendationService, method: str, path: str, body: bytes):
+    """Returns (status, json body) of one HTTP request"""
+    if method == "POST" and path == "/recommendations":
+        # parsing and validation errors are the client's, failures inside a batch are not
+        try:
+            request = json.loads(body)
+            if not request["anomalies"]:
+                return 200, json.dumps([])
+            anomaly = pd.DataFrame(request["anomalies"])
+            anomaly_recommendation = await service.recommend(
+                anomaly, request.get("anomaly_recommendation_id_start", 0)
+            )
+        except (json.JSONDecodeError, KeyError, ValueError) as e:
+            return 400, json.dumps({"error": str(e)})
+        return 200, anomaly_recommendation.to_json(orient="records")
+    if method == "GET" and path == "/stats":
+        return 200, json.dumps(service.get_stats())
+    if method == "POST" and path == "/reload":
+        await service.reload()
+        return 202, json.dumps({"status": "reloading"})
+    return 404, json.dumps({"error": f"{method} {path} not found"})
+
+
+async def _serve_connection(service: RecommendationService, reader, writer):
+    """Serves HTTP/1.1 requests of one connection until the client closes it"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode().split(" ", 2)
+
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            try:
+                status, response = await _handle_request(service, method, path, body)
+            except Exception as e:
+                logger.exception(e)
+                status, response = 500, json.dumps({"error": str(e)})
+
+            response = response.encode()
+            writer.write(
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(response)}\r\n\r\n".encode()
+                + response
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service: RecommendationService, host: str = "127.0.0.1", port: int = 8765, reload_interval: float = None):
+    """Runs the recommendation service until cancelled
+
+    Args:
+        service (RecommendationService): service to expose
+        host (str): host to bind. Defaults to "127.0.0.1".
+        port (int): port to bind. Defaults to 8765.
+        reload_interval (float, optional): seconds between background defect reloads. Defaults to None.
+    """
+    await service.start()
+    server = await asyncio.start_server(
+        lambda reader, writer: _serve_connection(service, reader, writer), host, port
+    )
+    logger.info(f"recommendation service listening on {host}:{port}")
+
+    async with server:
+        if reload_interval is None:
+            await server.serve_forever()
+        else:
+            # start_server already accepts connections, this loop only keeps serve() alive
+            while True:
+                await asyncio.sleep(reload_interval)
+                await service.reload()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Anomaly recommendation service")
+    parser.add_argument("defect_csv", help="csv file with the content of the defect table")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reload-interval", type=float, default=None, help="seconds between defect reloads")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--log-level", default="INFO", help="loguru level, DEBUG logs every recommendation")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    service = RecommendationService(
+        lambda: pd.read_csv(args.defect_csv),
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    asyncio.run(serve(service, args.host, args.port, args.reload_interval))
+
+
+if __name__ == "__main__":
+    main()
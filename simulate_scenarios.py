@@ -1,8 +1,12 @@
+import os
+import tempfile
+
 import pandas as pd
 import plotly.graph_objects as go
 import streamlit as st
 from plotly.subplots import make_subplots
 
+from utils_export import write_recommendation_xlsx
 from utils_recommendation import (get_anomaly_recommendation,
                                   get_defect_recommendation)
 
@@ -297,3 +301,25 @@ if st.button("Get recommendations"):
 
     st.info("Defect Recommendation")
     st.write(defect_recommendation)
+
+    output_fd, output_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(output_fd)
+    try:
+        write_recommendation_xlsx(
+            output_path,
+            {
+                "anomaly_recommendation": anomaly_recommendation,
+                "defect_recommendation": defect_recommendation,
+            },
+        )
+        with open(output_path, "rb") as output:
+            data = output.read()
+    finally:
+        os.remove(output_path)
+
+    st.download_button(
+        label="Download recommendations",
+        data=data,
+        file_name="recommendations.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
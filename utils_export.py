@@ -0,0 +1,165 @@
+import csv
+
+from loguru import logger
+
+import pandas as pd
+import xlsxwriter
+
+# xlsx worksheets are limited to 1048576 rows
+XLSX_MAX_ROWS = 1048576
+
+
+def iter_chunks(frame: pd.DataFrame, chunk_size: int = 100000):
+    """Yields consecutive row chunks of frame
+
+    Args:
+        frame (pd.DataFrame): dataframe to be exported
+        chunk_size (int): number of rows per chunk. Defaults to 100000.
+    """
+    if frame.shape[0] == 0:  # keep header of empty frames
+        yield frame
+        return
+
+    for start in range(0, frame.shape[0], chunk_size):
+        yield frame.iloc[start : start + chunk_size]
+
+
+def _write_frame_rows(worksheet, frame: pd.DataFrame, row: int, chunk_size: int):
+    """Writes header and rows of frame from row onwards, returns the next free row"""
+    worksheet.write_row(row, 0, [str(column) for column in frame.columns])
+    row += 1
+    for chunk in iter_chunks(frame, chunk_size):
+        # python objects with None for missing values, xlsxwriter writes those as blanks
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for values in chunk.itertuples(index=False):
+            worksheet.write_row(row, 0, values)
+            row += 1
+    return row
+
+
+def _write_csv_rows(f, frame: pd.DataFrame, chunk_size: int):
+    """Writes header and rows of frame to the open csv file f, chunk by chunk"""
+    for i, chunk in enumerate(iter_chunks(frame, chunk_size)):
+        chunk.to_csv(f, header=(i == 0), index=None)
+
+
+def write_inspection_csv(
+    path: str,
+    header_lines: list,
+    measurement: pd.DataFrame,
+    alarms: pd.DataFrame,
+    chunk_size: int = 100000,
+):
+    """Writes inspection data in the template_old.csv layout, chunk by chunk
+
+    Args:
+        path (str): output file path
+        header_lines (list): template header lines, e.g. "Sample Rate : 50"
+        measurement (pd.DataFrame): measurement matrix, one column per measurement type
+        alarms (pd.DataFrame): alarms with Channel, Meters, High/Low and value columns
+        chunk_size (int): number of rows per chunk. Defaults to 100000.
+
+    Returns:
+        path (str): output file path
+    """
+    n_columns = measurement.shape[1]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        # single value lines are padded to the measurement width, as in template_old.csv
+        for line in header_lines + [""]:
+            writer.writerow([line] + [""] * (n_columns - 1))
+        _write_csv_rows(f, measurement, chunk_size)
+        for line in ("", "Alarms"):
+            writer.writerow([line] + [""] * (n_columns - 1))
+        _write_csv_rows(f, alarms, chunk_size)
+
+    logger.debug(f"exported {measurement.shape[0]} measurements and {alarms.shape[0]} alarms to {path}")
+    return path
+
+
+def write_inspection_xlsx(
+    path: str,
+    header_lines: list,
+    measurement: pd.DataFrame,
+    alarms: pd.DataFrame,
+    chunk_size: int = 100000,
+):
+    """Writes inspection data in the template.xlsx layout, using xlsxwriter constant memory mode
+
+    Args:
+        path (str): output file path
+        header_lines (list): template header lines, e.g. "Sample Rate : 50"
+        measurement (pd.DataFrame): measurement matrix, one column per measurement type
+        alarms (pd.DataFrame): alarms with Channel, Meters, High/Low and value columns
+        chunk_size (int): number of rows per chunk. Defaults to 100000.
+
+    Returns:
+        path (str): output file path
+    """
+    n_rows = len(header_lines) + measurement.shape[0] + alarms.shape[0] + 5
+    if n_rows > XLSX_MAX_ROWS:
+        raise ValueError(
+            f"{n_rows} rows exceed the xlsx limit of {XLSX_MAX_ROWS}, please export to csv"
+        )
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    worksheet = workbook.add_worksheet("in")
+
+    row = 0
+    for line in header_lines:
+        worksheet.write_string(row, 0, line)
+        row += 1
+    row += 1  # blank row before measurements, as in template
+
+    row = _write_frame_rows(worksheet, measurement, row, chunk_size)
+    row += 1  # blank row before alarms, as in template
+    worksheet.write_string(row, 0, "Alarms")
+    _write_frame_rows(worksheet, alarms, row + 1, chunk_size)
+    workbook.close()
+
+    logger.debug(f"exported {measurement.shape[0]} measurements and {alarms.shape[0]} alarms to {path}")
+    return path
+
+
+def write_recommendation_xlsx(path: str, recommendations: dict, chunk_size: int = 100000):
+    """Writes recommendations to xlsx, one worksheet each, using xlsxwriter constant memory mode
+
+    Args:
+        path (str): output file path
+        recommendations (dict): worksheet name to dataframe, e.g. {"anomaly_recommendation": anomaly_recommendation}
+        chunk_size (int): number of rows per chunk. Defaults to 100000.
+
+    Returns:
+        path (str): output file path
+    """
+    for name, frame in recommendations.items():
+        if frame.shape[0] + 1 > XLSX_MAX_ROWS:
+            raise ValueError(
+                f"{name} has {frame.shape[0]} rows, exceeding the xlsx limit of {XLSX_MAX_ROWS}, please export to csv"
+            )
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    for name, frame in recommendations.items():
+        # constant memory mode flushes every row, so each worksheet is written in one go
+        _write_frame_rows(workbook.add_worksheet(name), frame, 0, chunk_size)
+    workbook.close()
+
+    return path
+
+
+def write_recommendation_csv(path: str, recommendation: pd.DataFrame, chunk_size: int = 100000):
+    """Writes recommendation dataframe to csv, chunk by chunk
+
+    Args:
+        path (str): output file path
+        recommendation (pd.DataFrame): anomaly or defect recommendation
+        chunk_size (int): number of rows per chunk. Defaults to 100000.
+
+    Returns:
+        path (str): output file path
+    """
+    with open(path, "w", newline="") as f:
+        _write_csv_rows(f, recommendation, chunk_size)
+
+    return path
+
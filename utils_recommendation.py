@@ -3,6 +3,138 @@ from loguru import logger
 import numpy as np
 import pandas as pd
 
+# maximum number of anomaly/defect pairs checked at once by get_overlapping_defects
+_OVERLAP_CHUNK_SIZE = 1000000
+
+# defects are only consolidated within the same line, subsystem and measurement type
+DEFECT_PARTITION_COLUMNS = ["line_id", "subsys_id", "measurement_type_id"]
+
+
+def get_defect_length(start_pos: np.ndarray, end_pos: np.ndarray):
+    """Returns defect length, zero-length defects are set to 1e-6
+
+    Args:
+        start_pos (np.ndarray): defect start positions
+        end_pos (np.ndarray): defect end positions
+
+    Returns:
+        length (np.ndarray): defect lengths, safe to be used as denominator
+    """
+    length = np.asarray(end_pos, dtype=float) - np.asarray(start_pos, dtype=float)
+    return np.where(length == 0, 1e-6, length)
+
+
+def get_overlapping_defects(
+    anomaly: pd.DataFrame,
+    defect: pd.DataFrame,
+    proximity: float = 0,
+    min_overlap_extent: float = 0.1,
+    sorted_index: np.ndarray = None,
+):
+    """Returns defects associated with every anomaly, searching defects sorted by start_pos
+
+    An anomaly is associated with a defect if one of them starts or ends within
+    the other, extended by proximity. Anomalies associated with more than one
+    defect keep only defects overlapped by at least min_overlap_extent.
+    Only defects starting within proximity plus the longest defect length of
+    an anomaly are checked, in chunks of at most _OVERLAP_CHUNK_SIZE pairs.
+
+    Args:
+        anomaly (pd.DataFrame): content of anomaly table
+        defect (pd.DataFrame): content of defect table
+        proximity (float): proximity tolerance of anomaly to defect. Defaults to 0.
+        min_overlap_extent (float): overlap extent in percentage. Defaults to 0.1, i.e. 10%.
+        sorted_index (np.ndarray, optional): positional order of defect by start_pos, computed if not given. Defaults to None.
+
+    Returns:
+        overlapping_defects (list): defect index labels associated with every anomaly row
+    """
+    anomaly_start = anomaly["start_pos"].values.astype(float)
+    anomaly_end = anomaly["end_pos"].values.astype(float)
+    defect_start = defect["start_pos"].values.astype(float)
+    defect_end = defect["end_pos"].values.astype(float)
+    length = get_defect_length(defect_start, defect_end)
+    if sorted_index is None:
+        sorted_index = np.argsort(defect_start, kind="stable")
+
+    # nan start positions are sorted last and checked against every anomaly
+    n_nan = int(np.isnan(defect_start).sum())
+    nan_positions = sorted_index[len(sorted_index) - n_nan :]
+    sorted_start = defect_start[sorted_index[: len(sorted_index) - n_nan]]
+
+    # every association implies a defect start within this window, even if start_pos > end_pos
+    defect_extent = np.abs(defect_end - defect_start)
+    max_extent = defect_extent[~np.isnan(defect_extent)].max(initial=0)
+    window_start = np.searchsorted(
+        sorted_start, np.fmin(anomaly_start, anomaly_end) - proximity - max_extent, side="left"
+    )
+    window_end = np.searchsorted(
+        sorted_start, np.fmax(anomaly_start, anomaly_end) + proximity + max_extent, side="right"
+    )
+    window_end = np.maximum(window_end, window_start)  # nan anomaly positions give empty windows
+
+    n_pairs = window_end - window_start + n_nan
+    cumulative_pairs = np.cumsum(n_pairs)
+    overlapping_defects = []
+    chunk_start = 0
+    while chunk_start < len(anomaly_start):
+        # at least one anomaly per chunk
+        chunk_end = max(
+            np.searchsorted(
+                cumulative_pairs,
+                cumulative_pairs[chunk_start] - n_pairs[chunk_start] + _OVERLAP_CHUNK_SIZE,
+                side="right",
+            ),
+            chunk_start + 1,
+        )
+        rows = np.arange(chunk_start, chunk_end)
+        n_window = window_end[rows] - window_start[rows]
+        pair_anomaly = np.concatenate((np.repeat(rows, n_window), np.repeat(rows, n_nan)))
+        pair_defect = np.concatenate(
+            (
+                sorted_index[
+                    np.repeat(window_start[rows] - (np.cumsum(n_window) - n_window), n_window)
+                    + np.arange(n_window.sum())
+                ],
+                np.tile(nan_positions, len(rows)),
+            )
+        )
+
+        a_start, a_end = anomaly_start[pair_anomaly], anomaly_end[pair_anomaly]
+        d_start, d_end = defect_start[pair_defect], defect_end[pair_defect]
+        overlapping = (
+            ((d_start <= a_end + proximity) & (d_start >= a_start - proximity))
+            | ((d_end <= a_end + proximity) & (d_end >= a_start - proximity))
+            | ((a_start <= d_end + proximity) & (a_start >= d_start - proximity))
+            | ((a_end <= d_end + proximity) & (a_end >= d_start - proximity))
+        )
+
+        # if no. of associated defects > 1, check for min_overlap_extent as well
+        n_associated = np.bincount(pair_anomaly[overlapping] - chunk_start, minlength=len(rows))
+        multiple = overlapping & (n_associated[pair_anomaly - chunk_start] > 1)
+        overlap_extent = (
+            np.maximum(
+                np.minimum(d_end[multiple], a_end[multiple])
+                - np.maximum(d_start[multiple], a_start[multiple]),
+                0,
+            )
+            / length[pair_defect[multiple]]
+        )
+        overlapping[multiple] = overlap_extent >= min_overlap_extent
+
+        # defects of every anomaly in table order, as a scan of the defect table returns them
+        pair_anomaly, pair_defect = pair_anomaly[overlapping], pair_defect[overlapping]
+        order = np.lexsort((pair_defect, pair_anomaly))
+        n_associated = np.bincount(pair_anomaly - chunk_start, minlength=len(rows))
+        overlapping_defects.extend(
+            defect.index.values[positions]
+            for positions in np.split(pair_defect[order], np.cumsum(n_associated)[:-1])
+        )
+        chunk_start = chunk_end
+
+    return overlapping_defects
+
+
 def get_anomaly_recommendation(
     anomaly: pd.DataFrame,
     defect: pd.DataFrame,
@@ -11,6 +143,8 @@ def get_anomaly_recommendation(
     min_severity_improvement: int = 1,
     min_overlap_extent: float = 0.1,
     anomaly_recommendation_id_start: int = 0,
+    overlapping_defects: list = None,
+    defect_sorted_index: np.ndarray = None,
 ):
     """Returns anomaly_recommendation dataframe
 
@@ -22,6 +156,8 @@ def get_anomaly_recommendation(
         min_severity_improvement (int): minimum severity improvement to create a new Defect. Defaults to 1.
         min_overlap_extent (float): overlap extent in percentage. Defaults to 0.1, i.e. 10%.
         anomaly_recommendation_id_start (int, optional): last index of anomaly recommendation table. Defaults to 0.
+        overlapping_defects (list, optional): output of get_overlapping_defects for anomaly, computed if not given. Defaults to None.
+        defect_sorted_index (np.ndarray, optional): positional order of defect by start_pos, e.g. from a defect snapshot. Defaults to None.
 
     Returns:
         anomaly_recommendation (pd.DataFrame): to be ingested into the anomaly_recommendation table
@@ -56,67 +192,17 @@ def get_anomaly_recommendation(
 
     # this section will be executed if defects exist
     logger.debug("past defects exist")
-    defect["length"] = defect["end_pos"] - defect["start_pos"]
-    defect["length"][defect["length"] == 0] = 1e-6
+    length = get_defect_length(defect["start_pos"].values, defect["end_pos"].values)
+    if "length" not in defect.columns or not np.array_equal(defect["length"].values, length):
+        # work on a copy so that shared/read-only defect tables are never mutated
+        defect = defect.assign(length=length)
 
-    for _, row in anomaly.iterrows():
+    if overlapping_defects is None:
+        overlapping_defects = get_overlapping_defects(
+            anomaly, defect, proximity, min_overlap_extent, defect_sorted_index
+        )
 
-        overlapping_index = defect[
-            (
-                (
-                    (defect.start_pos <= row.end_pos + proximity)
-                    & (defect.start_pos >= row.start_pos - proximity)
-                )
-                | (
-                    (defect.end_pos <= row.end_pos + proximity)
-                    & (defect.end_pos >= row.start_pos - proximity)
-                )
-                | (
-                    (row.start_pos <= defect.end_pos + proximity)
-                    & (row.start_pos >= defect.start_pos - proximity)
-                )
-                |(
-                    (row.end_pos <= defect.end_pos + proximity)
-                    & (row.end_pos >= defect.start_pos - proximity)
-                )
-            )
-        ].index.values
-
-        if len(overlapping_index) > 1:
-            # if no. of associated defects > 1,
-            # check for min_overlap_extent as well
-            start_pos = row.start_pos
-            end_pos = row.end_pos
-            overlapping_index = defect[
-                (
-                    (
-                        (defect.start_pos <= row.end_pos + proximity)
-                        & (defect.start_pos >= row.start_pos - proximity)
-                    )
-                    | (
-                        (defect.end_pos <= row.end_pos + proximity)
-                        & (defect.end_pos >= row.start_pos - proximity)
-                    )
-                    | (
-                    (row.start_pos <= defect.end_pos + proximity)
-                    & (row.start_pos >= defect.start_pos - proximity)
-                )
-                |(
-                    (row.end_pos <= defect.end_pos + proximity)
-                    & (row.end_pos >= defect.start_pos - proximity)
-                )
-                )
-                & (
-                    (
-                        (
-                            defect["end_pos"].apply(lambda x: min(x, end_pos))
-                            - defect["start_pos"].apply(lambda x: max(x, start_pos))
-                        ).apply(lambda x: max(x, 0))
-                    )
-                    / (defect["length"])
-                    >= min_overlap_extent
-                )
-            ].index.values
+    for (_, row), overlapping_index in zip(anomaly.iterrows(), overlapping_defects):
 
         if (len(overlapping_index) == 1) and (
             row.defect_code_id
@@ -335,16 +421,24 @@ def get_anomaly_recommendation(
 
 
 def get_defect_recommendation(
-    anomaly_recommendation: pd.DataFrame, defect: pd.DataFrame
+    anomaly_recommendation: pd.DataFrame,
+    defect: pd.DataFrame,
+    merge_proximity: float = None,
+    max_severity_difference: int = 0,
+    partition_columns: list = None,
 ):
     """Returns defect_recommendation
 
     Args:
         anomaly_recommendation (pd.DataFrame): anomaly recommendations from latest inspection run
         defect (pd.DataFrame): contents of defect able
+        merge_proximity (float, optional): if set, also recommend merging fragmented defects within this distance. Defaults to None.
+        max_severity_difference (int): maximum defect_code_id difference of defects to be merged. Defaults to 0.
+        partition_columns (list, optional): defects are only merged within the same values of these columns. Defaults to DEFECT_PARTITION_COLUMNS.
 
     Returns:
-        defect_recommendation (pd.DataFrame): defect recommendation dataframe primarily to close non-existent defects
+        defect_recommendation (pd.DataFrame): defect recommendation dataframe primarily to close non-existent defects,
+            with merge_proximity set also Merge rows with recommended_defect_id, merged_start_pos and merged_end_pos
     """
 
     recommended_defects = set(anomaly_recommendation.recommended_defect_id.dropna())  
@@ -364,4 +458,151 @@ def get_defect_recommendation(
     defect_recommendation.recommended_action_id = "Close"
     defect_recommendation.defect_recommendation_id = defect_recommendation.index
 
+    if merge_proximity is None:
+        return defect_recommendation
+
+    # only defects which stay open are consolidated
+    merge_recommendation = get_defect_merge_recommendation(
+        defect[~defect.defect_id.isin(defect_recommendation.defect_id)],
+        proximity=merge_proximity,
+        max_severity_difference=max_severity_difference,
+        partition_columns=partition_columns,
+    )
+    merge_recommendation = merge_recommendation[
+        defect_recommendation.columns.to_list()
+        + ["recommended_defect_id", "merged_start_pos", "merged_end_pos"]
+    ]
+    defect_recommendation = pd.concat(
+        [defect_recommendation, merge_recommendation], ignore_index=True
+    )
+    defect_recommendation.defect_recommendation_id = defect_recommendation.index
+
     return defect_recommendation
+
+
+def _find(parent: np.ndarray, i: int):
+    """Returns root of i in union-find parent array, with path halving"""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _union(parent: np.ndarray, i: int, j: int):
+    """Joins sets of i and j, the smaller root becomes the root of the joined set"""
+    root_i, root_j = _find(parent, i), _find(parent, j)
+    if root_i != root_j:
+        parent[max(root_i, root_j)] = min(root_i, root_j)
+
+
+def get_defect_clusters(
+    defect: pd.DataFrame,
+    proximity: float = 0,
+    max_severity_difference: int = 0,
+    partition_columns: list = None,
+):
+    """Returns cluster label of every defect, adjacent or overlapping defects share a label
+
+    Defects are sorted by partition and start_pos and swept once. For every
+    severity the sweep keeps the furthest end_pos seen so far, so each defect
+    is only compared against one running defect per severity, i.e. O(M log M).
+
+    Args:
+        defect (pd.DataFrame): content of defect table
+        proximity (float): maximum gap between defects to be clustered. Defaults to 0.
+        max_severity_difference (int): maximum defect_code_id difference within a cluster link. Defaults to 0.
+        partition_columns (list, optional): defects are only clustered within the same values of these columns. Defaults to DEFECT_PARTITION_COLUMNS.
+
+    Returns:
+        cluster (np.ndarray): positional index of the cluster root for every defect row
+    """
+    n_rows = len(defect)
+    parent = np.arange(n_rows)
+    if n_rows == 0:
+        return parent
+
+    if partition_columns is None:
+        partition_columns = DEFECT_PARTITION_COLUMNS
+    partition_columns = [column for column in partition_columns if column in defect.columns]
+    if partition_columns:
+        partition = defect.groupby(partition_columns, dropna=False, sort=False).ngroup().values
+    else:
+        partition = np.zeros(n_rows, dtype=int)
+
+    start_pos = defect["start_pos"].values.astype(float)
+    end_pos = defect["end_pos"].values.astype(float)
+    severity = defect["defect_code_id"].values
+
+    current_partition = None
+    running_end = {}  # severity -> (furthest end_pos, position of that defect)
+    for i in np.lexsort((start_pos, partition)):
+        if partition[i] != current_partition:
+            current_partition = partition[i]
+            running_end = {}
+
+        for running_severity, (end, j) in running_end.items():
+            if (
+                abs(severity[i] - running_severity) <= max_severity_difference
+                and start_pos[i] <= end + proximity
+            ):
+                _union(parent, i, j)
+
+        if severity[i] not in running_end or end_pos[i] > running_end[severity[i]][0]:
+            running_end[severity[i]] = (end_pos[i], i)
+
+    return np.array([_find(parent, i) for i in range(n_rows)])
+
+
+def get_defect_merge_recommendation(
+    defect: pd.DataFrame,
+    proximity: float = 0,
+    max_severity_difference: int = 0,
+    partition_columns: list = None,
+):
+    """Returns recommendations to merge fragmented defects into the cluster's lowest defect_id
+
+    Args:
+        defect (pd.DataFrame): content of defect table
+        proximity (float): maximum gap between defects to be merged. Defaults to 0.
+        max_severity_difference (int): maximum defect_code_id difference within a cluster link. Defaults to 0.
+        partition_columns (list, optional): defects are only merged within the same values of these columns. Defaults to DEFECT_PARTITION_COLUMNS.
+
+    Returns:
+        merge_recommendation (pd.DataFrame): one "Merge" row per defect to be merged into recommended_defect_id,
+            merged_start_pos and merged_end_pos give the extent of the consolidated defect
+    """
+    columns = [
+        "defect_recommendation_id",
+        "defect_id",
+        "recommended_action_id",
+        "recommended_defect_id",
+        "merged_start_pos",
+        "merged_end_pos",
+        "review_status_id",
+        "user",
+        "modified_dttm",
+    ]
+
+    clusters = pd.DataFrame(
+        {
+            "defect_id": defect["defect_id"].values,
+            "cluster": get_defect_clusters(
+                defect, proximity, max_severity_difference, partition_columns
+            ),
+            "start_pos": defect["start_pos"].values,
+            "end_pos": defect["end_pos"].values,
+        }
+    )
+    cluster_group = clusters.groupby("cluster")
+    clusters["recommended_defect_id"] = cluster_group["defect_id"].transform("min")
+    clusters["merged_start_pos"] = cluster_group["start_pos"].transform("min")
+    clusters["merged_end_pos"] = cluster_group["end_pos"].transform("max")
+
+    merge_recommendation = clusters[
+        clusters.defect_id != clusters.recommended_defect_id
+    ].reset_index(drop=True)
+    logger.debug(f"{merge_recommendation.shape[0]} defects to be merged")
+    merge_recommendation["recommended_action_id"] = "Merge"
+    merge_recommendation["defect_recommendation_id"] = merge_recommendation.index
+
+    return merge_recommendation.reindex(columns=columns)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def get_twist(crosslevel: np.ndarray, step: float, base_length: float = 3.0):
+    """Returns twist, i.e. change of crosslevel over base_length
+
+    Args:
+        crosslevel (np.ndarray): crosslevel measurements at equidistant points
+        step (float): distance between two consecutive measurements
+        base_length (float): twist base length, same unit as step. Defaults to 3.0.
+
+    Returns:
+        twist (np.ndarray): twist per measurement point, nan for the first base_length
+    """
+    crosslevel = np.asarray(crosslevel, dtype=float)
+    lag = max(int(round(base_length / step)), 1)
+    twist = np.full(crosslevel.shape, np.nan)
+    twist[lag:] = crosslevel[lag:] - crosslevel[:-lag]
+    return twist
+
+
+def get_derived_channels(
+    measurement: pd.DataFrame, step: float, twist_base_length: float = 3.0
+):
+    """Returns measurement with derived channels added (copy)
+
+    Args:
+        measurement (pd.DataFrame): measurement matrix with a Crosslevel column
+        step (float): distance between two consecutive measurements
+        twist_base_length (float): twist base length, same unit as step. Defaults to 3.0.
+
+    Returns:
+        measurement (pd.DataFrame): measurement with Twist computed from Crosslevel
+    """
+    return measurement.assign(
+        Twist=get_twist(measurement["Crosslevel"].values, step, twist_base_length)
+    )
+
+
+def get_rolling_exceedance(values: np.ndarray, window: int, threshold: float):
+    """Returns mask of points whose rolling peak (absolute) value exceeds threshold
+
+    Args:
+        values (np.ndarray): channel measurements
+        window (int): number of measurement points per window, centred on each point
+        threshold (float): absolute threshold of the channel
+
+    Returns:
+        exceedance (np.ndarray): boolean mask, same length as values
+    """
+    values = np.abs(np.asarray(values, dtype=float))
+    window = min(max(int(window), 1), len(values))
+    if window == 0:
+        return np.zeros(0, dtype=bool)
+
+    # pad with edge values so that every point gets a full window
+    padded = np.pad(values, (window // 2, (window - 1) // 2), mode="edge")
+    peak = sliding_window_view(padded, window).max(axis=1)
+    return peak > threshold
+
+
+def get_exceedance_segments(
+    distance: np.ndarray, values: np.ndarray, window: int, threshold: float
+):
+    """Returns contiguous segments where the rolling peak value exceeds threshold
+
+    Args:
+        distance (np.ndarray): distance of every measurement point
+        values (np.ndarray): channel measurements
+        window (int): number of measurement points per window
+        threshold (float): absolute threshold of the channel
+
+    Returns:
+        segments (pd.DataFrame): start_pos, end_pos and peak value of every segment
+    """
+    distance = np.asarray(distance, dtype=float)
+    values = np.asarray(values, dtype=float)
+    exceedance = get_rolling_exceedance(values, window, threshold)
+
+    # segment edges are where the mask switches
+    edges = np.diff(np.concatenate(([False], exceedance, [False])).astype(np.int8))
+    start_index = np.flatnonzero(edges == 1)
+    end_index = np.flatnonzero(edges == -1) - 1
+
+    # peak per segment, reduceat over [start, end + 1) pairs with a sentinel appended
+    bounds = np.column_stack((start_index, end_index + 1)).ravel()
+    peak = np.maximum.reduceat(np.append(np.abs(values), 0.0), bounds)[::2]
+
+    return pd.DataFrame(
+        {
+            "start_pos": distance[start_index],
+            "end_pos": distance[end_index],
+            "peak": peak,
+        }
+    )
+
+
+def _get_bucket_extreme_index(y: np.ndarray, edges: np.ndarray, bucket: np.ndarray, extreme):
+    """Returns index of the first minimum/maximum (extreme = np.minimum/np.maximum) of every bucket"""
+    bucket_extreme = extreme.reduceat(y, edges[:-1])
+    candidate = np.flatnonzero(y == bucket_extreme[bucket])
+    _, first = np.unique(bucket[candidate], return_index=True)
+    return candidate[first]
+
+
+def get_minmax_decimation(x: np.ndarray, y: np.ndarray, n_buckets: int = 2000):
+    """Returns decimated x, y keeping minimum and maximum of every bucket
+
+    Peaks survive decimation, so a full run can be plotted with at most
+    2 * n_buckets points.
+
+    Args:
+        x (np.ndarray): x values, e.g. distance
+        y (np.ndarray): y values, e.g. one measurement channel
+        n_buckets (int): number of buckets. Defaults to 2000.
+
+    Returns:
+        x_decimated (np.ndarray): x values of bucket minima and maxima, in original order
+        y_decimated (np.ndarray): y values of bucket minima and maxima, in original order
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    n_points = len(y)
+    if n_points <= 2 * n_buckets:
+        return x, y
+
+    # bucket sizes differ by at most one point, i.e. at most ceil(n_points / n_buckets)
+    edges = np.linspace(0, n_points, n_buckets + 1).astype(int)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+
+    # nan never wins, all-nan buckets fall back to their first point
+    index = [
+        _get_bucket_extreme_index(np.where(np.isnan(y), np.inf, y), edges, bucket, np.minimum),
+        _get_bucket_extreme_index(np.where(np.isnan(y), -np.inf, y), edges, bucket, np.maximum),
+    ]
+    index = np.unique(np.concatenate(index))
+    return x[index], y[index]